@@ -1,15 +1,21 @@
+import re
+from bisect import bisect_right
+
 DIGITS = "0123456789"
 
-# Token type => TT
-TT_INT = "INT"
-TT_FLOAT = "FLOAT"
-TT_PLUS = "PLUS"  # 加
-TT_MINUS = "MINUS"  # 减
-TT_MUL = "MUL"  # 乘
-TT_DIV = "DIV"  # 除
-TT_LPAREN = "LPAREN"  # 左括号
-TT_RPAREN = "RPAREN"  # 右括号
-TT_EOF = "EOF"  # 终止符
+# Token type => TT，使用小整数，便于用作查表下标
+TT_INT = 0
+TT_FLOAT = 1
+TT_PLUS = 2  # 加
+TT_MINUS = 3  # 减
+TT_MUL = 4  # 乘
+TT_DIV = 5  # 除
+TT_LPAREN = 6  # 左括号
+TT_RPAREN = 7  # 右括号
+TT_EOF = 8  # 终止符
+
+# TT => 名字，调试输出时使用
+_TT_NAMES = ("INT", "FLOAT", "PLUS", "MINUS", "MUL", "DIV", "LPAREN", "RPAREN", "EOF")
 
 """
 自定义 Error
@@ -56,142 +62,174 @@ class InvalidSyntaxError(Error):
         super().__init__(pos_start, pos_end, "Invalid Syntax", detail)
 
 
+"""
+语法解析异常，携带 InvalidSyntaxError，由 Parser.parse 捕获
+"""
+
+
+class ParseError(Exception):
+    def __init__(self, err):
+        super().__init__(err)
+        self.err = err
+
+
 """
 词法单元
 """
 
 
 class Token(object):
+    __slots__ = ('type', 'value', 'lexer', '_pos_start', '_pos_end')
+
     # type - value
-    def __init__(self, type_, value=None, pos_start=None, pos_end=None):
+    def __init__(self, type_, value=None, pos_start=None, pos_end=None, lexer=None):
+        """
+        :param type_: 词法单元类型
+        :param value: 词法单元的值
+        :param pos_start: 起始位置，给出 lexer 时为索引
+        :param pos_end: 结束位置，给出 lexer 时为索引
+        :param lexer: Lexer 生成的 Token 只记录索引，读取 pos_start / pos_end 时才由 lexer 生成 Position
+        """
         self.type = type_
         self.value = value
-
-        if pos_start:  # Token 单个字符 + -> pos_start == pos_end
-            self.pos_start = pos_start.copy()
-            self.pos_end = pos_start.copy()
-            self.pos_end.advance(self.value)  # 传入 current_char 读取下一个 Token
-
-        if pos_end:  # Token 多个字符 123456
-            self.pos_end = pos_end
+        self.lexer = lexer
+        self._pos_start = pos_start
+        self._pos_end = pos_end
+
+        if lexer is None and pos_start and not pos_end:  # Token 单个字符 + -> pos_end 为 pos_start 的下一个位置
+            self._pos_end = pos_start.copy()
+            self._pos_end.advance()
+
+    @property
+    def pos_start(self):
+        if self.lexer is None:
+            return self._pos_start
+        return self.lexer.make_pos(self._pos_start)
+
+    @property
+    def pos_end(self):
+        if self.lexer is None:
+            return self._pos_end
+        return self.lexer.make_pos(self._pos_end)
 
     # 方便调试时，信息的查看
     def __repr__(self):
         if self.value:
-            return f'{self.type}: {self.value}'
-        return f'{self.type}'
+            return f'{_TT_NAMES[self.type]}: {self.value}'
+        return f'{_TT_NAMES[self.type]}'
 
 
 class Position(object):
-    def __init__(self, idx, ln, col, fn, ftxt):
+    __slots__ = ('idx', 'fn', 'ftxt', 'line_starts')
+
+    def __init__(self, idx, fn, ftxt, line_starts):
         """
         :param idx: 索引
-        :param ln: 行号
-        :param col: 列号
         :param fn: 文件来源
         :param ftxt: 文件内容
+        :param line_starts: ftxt 每一行起始位置的索引，用于计算行号、列号
         """
         self.idx = idx
-        self.ln = ln
-        self.col = col
         self.fn = fn
         self.ftxt = ftxt
+        self.line_starts = line_starts
 
-    # 预读
-    def advance(self, current_char):
-        """
-        :param current_char: 当前字符
-        :return:
-        """
-        self.idx += 1  # 索引 + 1
-        self.col += 1  # 列号 + 1
+    # 行号，只在报错时用到，读取时才通过二分查找计算
+    @property
+    def ln(self):
+        return bisect_right(self.line_starts, self.idx) - 1
 
-        if current_char == '\n':
-            self.col = 0  # 列号归 0
-            self.ln += 1  # 行号 + 1
+    # 列号
+    @property
+    def col(self):
+        return self.idx - self.line_starts[self.ln]
+
+    # 预读
+    def advance(self):
+        self.idx += 1  # 索引 + 1，行号、列号随 idx 自动更新
 
     # 实例化Position
     def copy(self):
-        return Position(self.idx, self.ln, self.col, self.fn, self.ftxt)
+        return Position(self.idx, self.fn, self.ftxt, self.line_starts)
 
 
 """
 词法解析器
 """
 
+# 在 ASCII 字节上匹配，每个词素为：前导空白 + 数字（整数、小数）或单个非空白字节（运算符、括号或非法字符），
+# 具体类型由 _DISPATCH 决定。空白并入后一个词素，不再单独占用一次循环；末尾的空白不会被匹配
+_SCAN = re.compile(rb'[ \t]*(?:[0-9]+(?:\.[0-9]*)?|[^ \t])')
+
+# 运算符 => Token 类型
+_OP_TYPES = {
+    '+': TT_PLUS,
+    '-': TT_MINUS,
+    '*': TT_MUL,
+    '/': TT_DIV,
+    '(': TT_LPAREN,
+    ')': TT_RPAREN,
+}
+
+# 小数点的字节值，对 bytes 用 int 做 in 判断比用 b'.' 快得多
+_DOT = ord('.')
+
+# 以首字节为下标的分派表：Token 类型、_DIGIT 或 None（非法字符）
+_DIGIT = object()
+_DISPATCH = [None] * 128
+for _ch in DIGITS:
+    _DISPATCH[ord(_ch)] = _DIGIT
+for _ch, _tt in _OP_TYPES.items():
+    _DISPATCH[ord(_ch)] = _tt
+
 
 class Lexer(object):
     def __init__(self, fn, text):
         self.fn = fn
-        self.text = text
-        self.pos = Position(-1, 0, -1, fn, text)
-        self.current_char = None  # 当前的字符
-        self.advance()
-
-    # 预读
-    def advance(self):
-        self.pos.advance(self.current_char)  # 此时已经 self.pos.idx + 1
-        if self.pos.idx < len(self.text):
-            self.current_char = self.text[self.pos.idx]  # text => string, 可以根据索引取下一个位置
-        else:
-            self.current_char = None
-
-    # 通过 advance() 遍历 text，并判断遍历的结果是否为关键字
+        self.text = text  # 只用于报错
+        # 词法分析在 ASCII 字节上进行，非 ASCII 字符替换为一个 '?'，保证字节索引与字符索引一致
+        self._buf = text.encode('ascii', errors='replace')
+        # 每一行起始位置的索引，Position 读取行号、列号时才通过它计算
+        self._line_starts = [0]
+        idx = text.find('\n')
+        while idx != -1:
+            self._line_starts.append(idx + 1)
+            idx = text.find('\n', idx + 1)
+
+    # 根据索引生成 Position，只在报错、读取 Token 位置时调用
+    def make_pos(self, idx):
+        return Position(idx, self.fn, self.text, self._line_starts)
+
+    # 通过预编译的正则 _SCAN 一次性把 _buf 切分成词素，再根据首字节查 _DISPATCH 生成 Token
     def make_tokens(self):
-        tokens = []
-
-        while self.current_char is not None:
-            if self.current_char in (' ', '\t'):  # 若为空格或者制表符，词法分析器则自动跳过，不作处理
-                self.advance()  # 往下读取
-            elif self.current_char in DIGITS:  # 数字
-                tokens.append(self.make_number())  # 通过调用 make_number() 将该数字添加到词法单元里面
-            elif self.current_char == '+':
-                tokens.append(Token(TT_PLUS, pos_start=self.pos))
-                self.advance()
-            elif self.current_char == '-':
-                tokens.append(Token(TT_MINUS, pos_start=self.pos))
-                self.advance()
-            elif self.current_char == '*':
-                tokens.append(Token(TT_MUL, pos_start=self.pos))
-                self.advance()
-            elif self.current_char == '/':
-                tokens.append(Token(TT_DIV, pos_start=self.pos))
-                self.advance()
-            elif self.current_char == '(':
-                tokens.append(Token(TT_LPAREN, pos_start=self.pos))
-                self.advance()
-            elif self.current_char == ')':
-                tokens.append(Token(TT_RPAREN, pos_start=self.pos))
-                self.advance()
+        lexemes = _SCAN.findall(self._buf)
+        # 词素个数 + 1（EOF）即 Token 个数，预先分配好列表，按下标 k 填入
+        tokens = [None] * (len(lexemes) + 1)
+        k = 0
+
+        # 词素首尾相接覆盖 _buf（末尾空白除外），索引由词素长度累加得到；
+        # 去掉前导空白后的长度即 Token 本身的长度
+        end = 0
+        for s in lexemes:
+            end += len(s)
+            s = s.lstrip(b' \t')
+            start = end - len(s)
+            entry = _DISPATCH[s[0]]  # 字节即 int，直接作为下标
+            if entry is _DIGIT:  # 数字：整数、小数 => 0.1  （0 小数点 1）
+                if _DOT not in s:  # 若为整数
+                    tokens[k] = Token(TT_INT, int(s), start, end, self)
+                else:
+                    tokens[k] = Token(TT_FLOAT, float(s), start, end, self)
+            elif entry is not None:  # + - * / ( )
+                tokens[k] = Token(entry, None, start, end, self)
             else:  # 没有匹配到，非法字符错误
-                # python 引用性调用 错误提示中包含当前位置，所以需要把当前位置 copy 出来
-                # 若不 copy，则在操作该数据时，原本数据也会遭受影响
-                pos_start = self.pos.copy()
-                char = self.current_char  # 报错的那个字节
-                self.advance()
-                return [], IllegalCharError(pos_start, self.pos, f"'{char}'")
-        tokens.append(Token(TT_EOF, pos_start=self.pos))
+                char = self.text[start]  # 报错的那个字符，取自原始 text
+                return [], IllegalCharError(self.make_pos(start), self.make_pos(end), f"'{char}'")
+            k += 1
+        end = len(self.text)
+        tokens[k] = Token(TT_EOF, None, end, end + 1, self)
         return tokens, None
 
-    # 整数、小数 => 0.1  （0 小数点 1）
-    def make_number(self):
-        num_str = ''  # 最终识别出来的结果
-        dot_count = 0  # 小数点的个数
-
-        while self.current_char is not None and self.current_char in DIGITS + '.':  # DIGITS + '.' => "0123456789."
-            if self.current_char == '.':
-                if dot_count == 1:
-                    break
-                dot_count += 1
-                num_str += '.'
-            else:  # 当前字符不为小数点时，添加到 num_str 中
-                num_str += self.current_char
-            self.advance()  # 往下读，获取下一个
-        if dot_count == 0:  # 若为整数
-            return Token(TT_INT, int(num_str))  # 强制转换成 int
-        else:
-            return Token(TT_FLOAT, float(num_str))  # 强制转换成 float
-
 
 """
 数字结点
@@ -199,6 +237,8 @@ class Lexer(object):
 
 
 class NumberNode(object):
+    __slots__ = ('tok',)
+
     def __init__(self, tok):
         self.tok = tok
 
@@ -212,6 +252,8 @@ class NumberNode(object):
 
 
 class BinOpNode(object):
+    __slots__ = ('left_node', 'op_tok', 'right_node')
+
     def __init__(self, left_node, op_tok, right_node):
         self.left_node = left_node
         self.op_tok = op_tok
@@ -227,6 +269,8 @@ class BinOpNode(object):
 
 
 class UnaryOpNode(object):
+    __slots__ = ('op_tok', 'node')
+
     def __init__(self, op_tok, node):
         self.op_tok = op_tok
         self.node = node
@@ -256,104 +300,144 @@ class ParserResult(object):
         self.error = error
         return self
 
-    # 存储解析的结果
-    def register(self, res):
-        if isinstance(res, ParserResult):
-            if res.error:
-                self.error = res.error
-            return res.node
-        return res
-
 
 """
 语法解析器
 """
 
+# 以 TT 为下标的二元运算符优先级，数值越大结合越紧：expr 层为 + -，term 层为 * /，0 表示不是二元运算符
+_BIN_PREC = [0] * len(_TT_NAMES)
+_BIN_PREC[TT_PLUS] = _BIN_PREC[TT_MINUS] = 1
+_BIN_PREC[TT_MUL] = _BIN_PREC[TT_DIV] = 2
+# 一元运算符的操作数只能是 factor，不吸收任何二元运算符
+_UNARY_PREC = 3
+
 
 class Parser(object):
-    # 接收词法解析后的结果 Tokens
+    # 接收词法解析后的结果 Tokens，最后一个一定是 TT_EOF
     def __init__(self, tokens):
         self.tokens = tokens
-        self.tok_idx = -1
-        self.advance()  # 往下读取 Token
+        self.tok_idx = 0
+        self.current_tok = tokens[0]
 
-    # noinspection PyAttributeOutsideInit
+    # TT_EOF 不会被越过，因此无需检查 tok_idx 是否越界
     def advance(self):
         self.tok_idx += 1
-        if self.tok_idx < len(self.tokens):
-            self.current_tok = self.tokens[self.tok_idx]
+        self.current_tok = self.tokens[self.tok_idx]
         return self.current_tok
 
+    # 各语法规则直接返回结点，出错时抛出 ParseError，只在这里转换为 ParserResult
     def parse(self):
-        res = self.expr()
-        if not res.error and self.current_tok.type != TT_EOF:
-            return res.failure(InvalidSyntaxError(
-                self.current_tok.pos_start, self.current_tok.pos_end,
-                "Expected '+' '-' '*' or '/' "
-            ))
-        return res
+        res = ParserResult()
+        try:
+            node = self.parse_expr()
+            if self.current_tok.type != TT_EOF:
+                raise ParseError(InvalidSyntaxError(
+                    self.current_tok.pos_start, self.current_tok.pos_end,
+                    "Expected '+' '-' '*' or '/' "
+                ))
+        except ParseError as e:
+            return res.failure(e.err)
+        return res.success(node)
 
-    def factor(self):
+    def parse_expr(self, min_prec=1):
         """
+        expr   -> term (( PLUS | MINUS ) term)*
+        term   -> factor (( MUL | DIV ) factor)*
         factor -> INT | FLOAT
                -> ( PLUS | MINUS ) factor
                -> LPAREN expr RPAREN
-        :return:
+
+        Pratt 解析：先解析一个 factor，再循环吸收优先级不低于 min_prec 的二元运算符，
+        右操作数以 prec + 1 递归解析，从而实现左结合。
+        本层直接用局部变量 i 读取 tokens，只在递归前后与 self.tok_idx 同步，返回前再更新 self.current_tok
+        :param min_prec: 本层允许吸收的最低优先级，见 _BIN_PREC
+        :return: AST 结点，语法错误时抛出 ParseError
         """
 
-        res = ParserResult()  # 拿到语法解析的结果
-        tok = self.current_tok
+        tokens = self.tokens
+        i = self.tok_idx
+        tok = tokens[i]
 
         # factor -> INT | FLOAT
-        if tok.type in (TT_INT, TT_FLOAT):
-            res.register(self.advance())
-            return res.success(NumberNode(tok))
+        if tok.type <= TT_FLOAT:  # TT_INT 或 TT_FLOAT
+            i += 1
+            left = NumberNode(tok)
 
         # factor -> ( PLUS | MINUS ) factor
         elif tok.type in (TT_PLUS, TT_MINUS):
-            res.register(self.advance())
-            factor = res.register(self.factor())
-            if res.error:
-                return res
-            return res.success(UnaryOpNode(tok, factor))
+            self.tok_idx = i + 1
+            left = UnaryOpNode(tok, self.parse_expr(_UNARY_PREC))
+            i = self.tok_idx
 
+        # factor -> LPAREN expr RPAREN
         elif tok.type == TT_LPAREN:
-            res.register(self.advance())  # 获取下一个字符
-            expr = res.register((self.expr()))
-            if res.error:
-                return res
-
-            if self.current_tok.type == TT_RPAREN:
-                res.register(self.advance())
-                return res.success(expr)
-            else:  # 报错
-                return res.failure(InvalidSyntaxError(
-                    self.current_tok.pos_start, self.current_tok.pos_end,
+            self.tok_idx = i + 1  # 获取下一个字符
+            left = self.parse_expr()
+            i = self.tok_idx
+            if tokens[i].type != TT_RPAREN:  # 报错
+                raise ParseError(InvalidSyntaxError(
+                    tokens[i].pos_start, tokens[i].pos_end,
                     "Expected ')' "
                 ))
-        return res.failure(InvalidSyntaxError(
-            self.current_tok.pos_start, self.current_tok.pos_end,
-            "Expected int or float "
-        ))
+            i += 1
 
-    # term -> factor (( MUL | DIY ) factor)*
-    def term(self):
-        return self.bin_op(self.factor, (TT_MUL, TT_DIV))
+        else:
+            raise ParseError(InvalidSyntaxError(
+                tok.pos_start, tok.pos_end,
+                "Expected int or float "
+            ))
 
-    # expr -> term (( PLUS | MINUS ) term)*
-    def expr(self):
-        return self.bin_op(self.term, (TT_PLUS, TT_MINUS))
+        # (( PLUS | MINUS | MUL | DIV ) 右操作数)*
+        while True:
+            op_tok = tokens[i]
+            prec = _BIN_PREC[op_tok.type]
+            if prec < min_prec:
+                break
+            self.tok_idx = i + 1
+            left = BinOpNode(left, op_tok, self.parse_expr(prec + 1))
+            i = self.tok_idx
 
-    # 递归调用构建AST
-    def bin_op(self, func, ops):
-        res = ParserResult()
-        left = res.register(func())
-        while self.current_tok.type in ops:
-            op_tok = self.current_tok
-            res.register((self.advance()))
-            right = res.register(func())
-            left = BinOpNode(left, op_tok, right)
-        return res.success(left)
+        self.tok_idx = i
+        self.current_tok = op_tok
+        return left
+
+
+"""
+编译：把 AST 转换为等价的 Python 表达式，交给 CPython 编译成 code 对象，之后可反复 eval 求值
+"""
+
+# TT => 运算符
+_OP_CHARS = {tt: ch for ch, tt in _OP_TYPES.items()}
+
+
+def to_source(node, min_prec=1):
+    """
+    与 Parser.parse_expr 对称，只在子表达式优先级低于 min_prec 时加括号，
+    避免层层括号超过 CPython 的括号嵌套上限
+    :param node: AST 结点
+    :param min_prec: 所在位置要求的最低优先级，见 _BIN_PREC
+    :return: Python 表达式字符串
+    """
+    if isinstance(node, NumberNode):
+        value = node.tok.value
+        if value == float('inf'):  # 超出 float 范围的小数，repr 为 inf，无法作为 Python 字面量
+            return '1e999'
+        return repr(value)
+
+    if isinstance(node, UnaryOpNode):
+        return _OP_CHARS[node.op_tok.type] + to_source(node.node, _UNARY_PREC)
+
+    prec = _BIN_PREC[node.op_tok.type]
+    src = to_source(node.left_node, prec) + _OP_CHARS[node.op_tok.type] + to_source(node.right_node, prec + 1)
+    if prec < min_prec:
+        return f'({src})'
+    return src
+
+
+# 编译 AST，返回的 code 对象可以反复 eval(code) 求值
+def compile_node(node, fn='<expr>'):
+    return compile(to_source(node), fn, 'eval')
 
 
 """
@@ -365,6 +449,8 @@ def run(fn, text):  # fn：从键盘输入的数据，text的来源，<stdin>
     lexer = Lexer(fn, text)
     tokens, error = lexer.make_tokens()
     print(tokens)
+    if error:  # 词法错误时没有 Token（也没有 TT_EOF），不再进行语法解析
+        return None, error
     # 生成AST
     parser = Parser(tokens)
     ast = parser.parse()